@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""Differential check of the optimized benefits pipeline against the
+legacy row-wise implementation.
+
+Both paths run on the same processed flights (a real fullFlightSummary
+sample or a synthetic one). The legacy path builds program masks from
+the raw columns, resolves claims with the gufi flight list and computes
+emissions with calc_emissions row by row. The fast path uses the packed
+program bitmaps and the bulk flight_emissions() columns. The excess
+emission table is computed with the row and the frame mops_emission
+functions, the quarantine is checked against a row-wise evaluation of the
+reason checks and the month-partitioned metrics against the sequential
+ones. Every column of every output table is compared within tolerance and
+the timings and divergences are reported per stage.
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import benefits_summary_with_filter as bsf
+import mops_emission as mem
+
+DEFAULT_RTOL = 1e-9
+DEFAULT_ATOL = 1e-6
+DEFAULT_SYNTHETIC_FLIGHTS = 5000
+DEFAULT_JOBS = 2
+MAX_REPORTED_DIVERGENCES = 10
+
+AIRCRAFT_TYPES = ["A319", "A320", "A321", "B738", "CRJ9", "E145", "E170",
+                  "MD88", "B77W", None]
+
+
+def synthetic_ffs(n_flights, airport=bsf.DEFAULT_AIRPORT, seed=0):
+    """A random flight frame with the fullFlightSummary columns used by the
+    pipeline, as returned by load_ffs_data()."""
+    rng = np.random.default_rng(seed)
+
+    def seconds(low, high):
+        return pd.to_timedelta(rng.integers(low, high, n_flights), unit="s")
+
+    stand = (pd.Timestamp("2019-01-01") +
+             seconds(0, 365 * 86400)).to_series(index=range(n_flights))
+    apreq_initial = stand + seconds(0, 1800)
+    movement_area = stand + seconds(60, 900)
+    hold_indicator = rng.random(n_flights) < 0.3
+
+    return pd.DataFrame({
+        "gufi":pd.Series(["SYN.{}.{}".format(
+                    airport, i % (n_flights - n_flights // 50))
+                for i in range(n_flights)]).where(
+                    rng.random(n_flights) > 0.05),
+        "aircraft_type":rng.choice(np.array(AIRCRAFT_TYPES, dtype=object),
+                                   n_flights),
+        "flight_category":rng.choice(
+                ["aal_mainline", "aal_regional", "other"], n_flights),
+        "departure_aerodrome_icao_name":rng.choice(
+                [airport, airport, airport, "KATL"], n_flights),
+        "departure_stand_actual_time":stand,
+        "pilot_ready_time":(stand - seconds(-120, 1500)).where(
+                rng.random(n_flights) > 0.03),
+        "time_at_initial_apreq":stand - seconds(0, 3600),
+        "apreq_initial":apreq_initial,
+        "apreq_final":apreq_initial - seconds(-300, 600),
+        "apreq_initial_source":rng.choice(["IDAC", "TBFM"], n_flights),
+        "apreq_final_source":rng.choice(["IDAC", "TBFM"], n_flights),
+        "surface_flight_state_at_initial_apreq":rng.choice(
+                ["SCHEDULED", "PUSHBACK", "TAXI"], n_flights),
+        "edct_at_ready":apreq_initial.where(rng.random(n_flights) < 0.1),
+        "ground_stop_restriction_ids_present":rng.random(n_flights) < 0.05,
+        "metered_indicator":rng.random(n_flights) < 0.5,
+        "hold_indicator":hold_indicator,
+        "actual_gate_hold":np.where(hold_indicator,
+                                    rng.integers(1, 20, n_flights), 0),
+        "gate_hold_fuel_savings":rng.random(n_flights) * 50,
+        "gate_hold_co_savings":rng.random(n_flights) * 500,
+        "gate_hold_co2_savings":rng.random(n_flights) * 150,
+        "gate_hold_hc_savings":rng.random(n_flights) * 20,
+        "gate_hold_nox_savings":rng.random(n_flights) * 20,
+        "departure_movement_area_actual_time":movement_area,
+        "departure_runway_actual_time":movement_area + seconds(120, 1500)})
+
+
+def prepare_flights(df):
+    return bsf.modify_data(df)
+
+
+def compare_frames(legacy, fast, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL):
+    """Return a list of divergence descriptions, empty if equivalent.
+
+    legacy and fast are tables, or dicts of named tables compared name by
+    name."""
+    if isinstance(legacy, dict):
+        divergences = []
+        for name in legacy:
+            divergences.extend(
+                    "{}: {}".format(name, divergence)
+                    for divergence in compare_frames(
+                        legacy[name], fast.get(name), rtol, atol))
+        return divergences
+
+    if legacy is None or fast is None:
+        if legacy is None and fast is None:
+            return []
+        return ["only one path produced a table"]
+
+    divergences = []
+    missing = set(legacy.columns) ^ set(fast.columns)
+    if missing:
+        divergences.append("columns differ: {}".format(sorted(missing)))
+    if len(legacy) != len(fast):
+        divergences.append("row counts differ: {} vs {}".format(
+                len(legacy), len(fast)))
+        return divergences
+
+    keys = [c for c in ["year_month", "program", "gufi", "reasons"]
+            if c in legacy.columns]
+    if keys:
+        legacy = legacy.sort_values(keys, kind="stable").reset_index(
+                drop=True)
+        fast = fast.sort_values(keys, kind="stable").reset_index(drop=True)
+
+    for column in legacy.columns:
+        if column not in fast.columns:
+            continue
+        a = legacy[column]
+        b = fast[column]
+        if (pd.api.types.is_numeric_dtype(a) and
+                pd.api.types.is_numeric_dtype(b)):
+            a = a.astype(float).values
+            b = b.astype(float).values
+            idx_bad = ~np.isclose(a, b, rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            idx_null = a.isnull().values & b.isnull().values
+            a = a.astype(str).values
+            b = b.astype(str).values
+            idx_bad = (a != b) & ~idx_null
+        for i in np.flatnonzero(idx_bad):
+            divergences.append("{} row {}: legacy={} fast={}".format(
+                    column, i, a[i], b[i]))
+
+    return divergences
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run_stages(df, airport, fast):
+    """Run the pipeline stages in main() order, returning per stage the
+    output table and its run time in seconds."""
+    stages = {}
+    if fast:
+        (emissions, seconds) = _timed(bsf.flight_emissions, df)
+        df = df.assign(**emissions)
+        (bitmaps, bitmap_seconds) = _timed(bsf.build_program_bitmaps, df)
+        claims = bsf.new_claims(bitmaps)
+        stages["emissions"] = (None, seconds + bitmap_seconds)
+    else:
+        bitmaps = None
+        claims = None
+        stages["emissions"] = (None, 0.0)
+
+    ((gs, flight_list), seconds) = _timed(
+            bsf.gs_metrics_by_group, df, None, [], bitmaps, claims)
+    stages["gs"] = (gs, seconds)
+    ((edct, flight_list), seconds) = _timed(
+            bsf.edct_metrics_by_group, df, None, flight_list, bitmaps,
+            claims)
+    stages["edct"] = (edct, seconds)
+    ((apreq, flight_list), seconds) = _timed(
+            bsf.apreq_metrics_by_group, df, None, flight_list, bitmaps,
+            claims)
+    stages["apreq"] = (apreq, seconds)
+    ((meter, flight_list), seconds) = _timed(
+            bsf.metering_metrics_by_group, df, None, airport, flight_list,
+            bitmaps, claims, False)
+    stages["metering"] = (meter, seconds)
+    stages["summary"] = _timed(bsf.summarize_benefits, apreq, meter, edct, gs)
+    if all(c in df.columns for c in bsf.DEPARTURE_PHASE_TIMES):
+        stages["excess"] = _timed(bsf.excess_emission_metrics_by_group,
+                                  df, None, airport, not fast)
+
+    return stages
+
+
+def _row_reasons(row, aircraft_types):
+    one_day = pd.Timedelta(days=1)
+    gate_hold = row["departure_stand_actual_time"] - row["pilot_ready_time"]
+    negotiation = row["apreq_initial"] - row["apreq_final"]
+    held = row["hold_indicator"] == True
+
+    codes = []
+    if pd.isnull(row["departure_stand_actual_time"]):
+        codes.append("NAT_STAND_TIME")
+    if pd.isnull(row["pilot_ready_time"]):
+        codes.append("NAT_READY_TIME")
+    if pd.notnull(gate_hold) and gate_hold < pd.Timedelta(0):
+        codes.append("NEGATIVE_GATE_HOLD")
+    if pd.notnull(gate_hold) and gate_hold >= one_day:
+        codes.append("OVERDAY_GATE_HOLD")
+    if pd.notnull(negotiation) and negotiation >= one_day:
+        codes.append("OVERDAY_NEGOTIATION")
+    if row["aircraft_type"] not in aircraft_types:
+        codes.append("UNKNOWN_AIRCRAFT_TYPE")
+    if held and row["metered_indicator"] != True:
+        codes.append("HOLD_WITHOUT_METERING")
+    if held != (row["actual_gate_hold"] > 0):
+        codes.append("HOLD_FLAG_MISMATCH")
+    return codes
+
+
+def row_quarantine(df):
+    """The quarantine_flights() table, evaluating every check flight by
+    flight."""
+    aircraft_types = set(mem.emissionAircraftTypes())
+    rows = []
+    for _, row in df.iterrows():
+        codes = _row_reasons(row, aircraft_types)
+        if codes:
+            rows.append({"gufi":row["gufi"],
+                         "year_month":row["year_month"],
+                         "reason_mask":bsf.reason_mask(codes),
+                         "reasons":";".join(codes)})
+    return pd.DataFrame(rows,
+                        columns=["gufi", "year_month", "reason_mask",
+                                 "reasons"])
+
+
+def run_quarantine_stage(df):
+    legacy = _timed(row_quarantine, df)
+    fast = _timed(lambda: bsf.quarantine_flights(df, bsf.validate_data(df)))
+    return {"quarantine":(legacy, fast)}
+
+
+def _sequential_metrics(df, airport, bitmaps):
+    claims = bsf.new_claims(bitmaps)
+    tables = bsf.program_metrics(df, airport, bitmaps, claims,
+                                 debug_output=False)
+    return tables + [bsf.flight_attribution(df, bitmaps, claims)]
+
+
+def run_partition_stage(df, airport, jobs):
+    """program_metrics() and flight_attribution() over all flights against
+    partitioned_program_metrics() with jobs processes."""
+    df = df.assign(**bsf.flight_emissions(df))
+    bitmaps = bsf.build_program_bitmaps(df)
+    names = ["gs", "edct", "apreq", "metering", "excess", "attribution"]
+    (sequential, seconds) = _timed(_sequential_metrics, df, airport, bitmaps)
+    (partitioned, partitioned_seconds) = _timed(
+            bsf.partitioned_program_metrics, df, airport, bitmaps, jobs)
+    return {"partitioned":((dict(zip(names, sequential)), seconds),
+                           (dict(zip(names, partitioned)),
+                            partitioned_seconds))}
+
+
+def run_kernel_stages(df, airport):
+    """Row-wise and vectorized mops_emission phase kernels, on the phase
+    and excess times of the excess emission stage."""
+    if not all(c in df.columns for c in bsf.DEPARTURE_PHASE_TIMES):
+        return {}
+    phases = bsf.departure_phases(df, None, airport)
+    stages = {}
+    for name, row_func, frame_func in [
+            ("phase_total_emission", mem.row_get_total_emission,
+             mem.frame_get_total_emission),
+            ("phase_excess_emission", mem.row_get_excess_emission,
+             mem.frame_get_excess_emission)]:
+        legacy = _timed(lambda: phases.apply(row_func, axis=1))
+        fast = _timed(frame_func, phases)
+        stages[name] = (legacy, fast)
+    return stages
+
+
+def check_equivalence(df, airport, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL,
+                      jobs=DEFAULT_JOBS):
+    """Return a per stage report table of timings and divergences."""
+    legacy = run_stages(df, airport, fast=False)
+    fast = run_stages(df, airport, fast=True)
+    pairs = dict((name, (legacy[name], fast[name])) for name in legacy)
+    pairs.update(run_kernel_stages(df, airport))
+    pairs.update(run_quarantine_stage(df))
+    pairs.update(run_partition_stage(df, airport, jobs))
+
+    rows = []
+    for name, ((legacy_table, legacy_seconds),
+               (fast_table, fast_seconds)) in pairs.items():
+        divergences = compare_frames(legacy_table, fast_table, rtol, atol)
+        rows.append({
+            "stage":name,
+            "legacy_seconds":legacy_seconds,
+            "fast_seconds":fast_seconds,
+            "speedup":(legacy_seconds / fast_seconds
+                       if legacy_seconds > 0 and fast_seconds > 0
+                       else np.nan),
+            "divergences":len(divergences),
+            "first_divergences":"; ".join(
+                    divergences[:MAX_REPORTED_DIVERGENCES])})
+
+    report = pd.DataFrame(rows)
+    total = pd.DataFrame([{
+            "stage":"total",
+            "legacy_seconds":report["legacy_seconds"].sum(),
+            "fast_seconds":report["fast_seconds"].sum(),
+            "divergences":report["divergences"].sum(),
+            "first_divergences":""}])
+    total["speedup"] = total["legacy_seconds"] / total["fast_seconds"]
+    return pd.concat([report, total], ignore_index=True)
+
+
+def main(ffs_path, ffs_version, airport, synthetic, rtol, atol, jobs,
+         output):
+    if ffs_path:
+        df = bsf.load_ffs_data(ffs_path, airport, ffs_version)
+    else:
+        df = synthetic_ffs(synthetic, airport)
+    df = prepare_flights(df)
+
+    report = check_equivalence(df, airport, rtol, atol, jobs)
+    if output:
+        report.to_csv(output, index=False)
+
+    print("Compared {} flights".format(len(df)))
+    print(report.drop(columns=["first_divergences"]).to_string(
+            index=False, float_format="{:.4f}".format))
+    for _, row in report[report["divergences"] > 0].iterrows():
+        if row["first_divergences"]:
+            print("{}: {}".format(row["stage"], row["first_divergences"]))
+
+    return int(report["divergences"].iloc[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Compare the optimized and legacy benefits paths")
+    parser.add_argument("ffs_path",
+                        nargs="?",
+                        help="Path with fullFlightSummary files, a synthetic "
+                             "sample is used when omitted")
+    parser.add_argument("--ffs_version",
+                        default=bsf.DEFAULT_FFS_VERSION,
+                        help="fullFlightSummary version to open")
+    parser.add_argument("--airport",
+                        default=bsf.DEFAULT_AIRPORT,
+                        help="Airport to analyze, ICAO format")
+    parser.add_argument("--synthetic",
+                        type=int,
+                        default=DEFAULT_SYNTHETIC_FLIGHTS,
+                        help="Number of synthetic flights")
+    parser.add_argument("--rtol",
+                        type=float,
+                        default=DEFAULT_RTOL,
+                        help="Relative tolerance of numeric columns")
+    parser.add_argument("--atol",
+                        type=float,
+                        default=DEFAULT_ATOL,
+                        help="Absolute tolerance of numeric columns")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=DEFAULT_JOBS,
+                        help="Number of processes of the month-partitioned "
+                             "metrics")
+    parser.add_argument("--output",
+                        help="CSV file receiving the per stage report")
+    args = parser.parse_args()
+
+    sys.exit(1 if main(args.ffs_path, args.ffs_version, args.airport,
+                       args.synthetic, args.rtol, args.atol, args.jobs,
+                       args.output) else 0)
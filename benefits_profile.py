@@ -0,0 +1,164 @@
+"""Profiling support for the benefits summary pipeline.
+
+Runs a callable under cProfile while a background thread samples the
+stacks of every thread, then writes a sorted text report (pipeline stage
+breakdown plus the hottest functions of the benefits and emission modules)
+and a flamegraph-compatible collapsed-stack file.
+"""
+
+import cProfile
+import collections
+import io
+import os.path
+import pstats
+import sys
+import threading
+import time
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_TOP_FUNCTIONS = 25
+
+# Pipeline functions called directly from these functions are reported
+# as stages, the roots themselves are not
+STAGE_ROOTS = ("main", "program_metrics")
+HOT_PATH_MODULES = ("benefits_summary_with_filter.py", "mops_emission.py")
+
+
+class StackSampler(threading.Thread):
+    """Periodically records the stacks of all other threads."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != self.ident:
+                    self.stacks[_frame_stack(frame)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _frame_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{}:{}".format(
+                os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+def _func_label(func):
+    filename, lineno, name = func
+    return "{}:{}({})".format(os.path.basename(filename), lineno, name)
+
+
+def profile_call(func, args, prefix, interval=DEFAULT_SAMPLE_INTERVAL,
+                 top=DEFAULT_TOP_FUNCTIONS):
+    """Call func(*args) under the profilers and write the reports.
+
+    Produces <prefix>.prof (raw pstats dump), <prefix>.txt (sorted text
+    report) and <prefix>.collapsed (one "frame;frame;... count" line per
+    distinct sampled stack, consumable by flamegraph.pl or speedscope).
+    """
+    sampler = StackSampler(interval)
+    profiler = cProfile.Profile()
+
+    sampler.start()
+    wall_start = time.perf_counter()
+    profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        profiler.disable()
+        wall_time = time.perf_counter() - wall_start
+        sampler.stop()
+
+        profiler.dump_stats(prefix + ".prof")
+        with open(prefix + ".txt", "w") as f:
+            f.write(format_report(profiler, sampler.stacks, wall_time, top))
+        write_collapsed_stacks(sampler.stacks, prefix + ".collapsed")
+
+    return result
+
+
+def write_collapsed_stacks(stacks, path):
+    with open(path, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            f.write("{} {}\n".format(";".join(stack), count))
+
+
+def stage_times(stats):
+    """Cumulative seconds spent in each pipeline function called from one
+    of STAGE_ROOTS."""
+    stages = collections.defaultdict(float)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if (os.path.basename(func[0]) not in HOT_PATH_MODULES or
+                func[2] in STAGE_ROOTS):
+            continue
+        for caller, caller_stats in callers.items():
+            if (caller[2] in STAGE_ROOTS and
+                    os.path.basename(caller[0]) in HOT_PATH_MODULES):
+                stages[func] += caller_stats[3]
+    return stages
+
+
+def sampled_stage_counts(stacks):
+    """Number of samples per stage, keyed on the deepest pipeline frame
+    called from one of STAGE_ROOTS."""
+    roots = set("{}:{}".format(module, root)
+                for module in HOT_PATH_MODULES for root in STAGE_ROOTS)
+    counts = collections.Counter()
+    for stack, count in stacks.items():
+        stage = None
+        for caller, frame in zip(stack, stack[1:]):
+            if (caller in roots and frame not in roots and
+                    frame.split(":")[0] in HOT_PATH_MODULES):
+                stage = frame
+        if stage is not None:
+            counts[stage] += count
+    return counts
+
+
+def format_report(profiler, stacks, wall_time, top=DEFAULT_TOP_FUNCTIONS):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+
+    out.write("Wall time: {:.3f} s\n".format(wall_time))
+    out.write("Samples collected: {}\n\n".format(sum(stacks.values())))
+
+    out.write("==== Pipeline stages (cProfile cumulative) ====\n")
+    stages = stage_times(stats)
+    total = sum(stages.values()) or 1.0
+    for func, seconds in sorted(stages.items(), key=lambda x: -x[1]):
+        out.write("{:10.3f} s  {:5.1f}%  {}\n".format(
+                seconds, 100 * seconds / total, _func_label(func)))
+
+    out.write("\n==== Pipeline stages (sampled) ====\n")
+    counts = sampled_stage_counts(stacks)
+    n_samples = sum(counts.values()) or 1
+    for stage, count in counts.most_common():
+        out.write("{:10d}    {:5.1f}%  {}\n".format(
+                count, 100 * count / n_samples, stage))
+
+    hot = [(func, entry) for func, entry in stats.stats.items()
+           if os.path.basename(func[0]) in HOT_PATH_MODULES]
+    for title, column in (("own time", 2), ("cumulative time", 3)):
+        out.write("\n==== Hottest pipeline functions by {} ====\n".format(
+                title))
+        out.write("{:>10s}  {:>10s}  {:>10s}  {}\n".format(
+                "ncalls", "tottime", "cumtime", "function"))
+        for func, entry in sorted(hot, key=lambda x: -x[1][column])[:top]:
+            out.write("{:10d}  {:10.3f}  {:10.3f}  {}\n".format(
+                    entry[1], entry[2], entry[3], _func_label(func)))
+
+    out.write("\n==== All functions by cumulative time ====\n")
+    stats.sort_stats("cumulative").print_stats(top * 2)
+
+    return out.getvalue()
@@ -0,0 +1,142 @@
+"""Local SQLite store accumulating the benefits outputs of every run.
+
+Monthly program metrics and the summary row are stored in long format
+(one row per metric value) and the per-flight program attribution one row
+per flight, all indexed on airport, program and month so that trend
+queries across runs do not need to parse the per-run CSV files.
+"""
+
+import datetime as dt
+import sqlite3
+
+import pandas as pd
+
+BATCH_SIZE = 50000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_time TEXT NOT NULL,
+    airport TEXT NOT NULL,
+    ffs_path TEXT
+);
+CREATE TABLE IF NOT EXISTS program_metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    airport TEXT NOT NULL,
+    program TEXT NOT NULL,
+    year_month TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS program_metrics_lookup
+    ON program_metrics (airport, program, year_month);
+CREATE TABLE IF NOT EXISTS summary_metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    airport TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS summary_metrics_lookup
+    ON summary_metrics (airport, metric);
+CREATE TABLE IF NOT EXISTS flight_attribution (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    airport TEXT NOT NULL,
+    program TEXT NOT NULL,
+    year_month TEXT NOT NULL,
+    gufi TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flight_attribution_lookup
+    ON flight_attribution (airport, program, year_month);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def sortable_month(year_month):
+    """Zero-pad the month of a "YYYY-M" year_month so that months sort as
+    text, other values (e.g. "nan-nan") are kept as they are."""
+    year, _, month = str(year_month).partition("-")
+    if year.isdigit() and month.isdigit():
+        return "{}-{:02d}".format(year, int(month))
+    return str(year_month)
+
+
+def _insert_batches(conn, sql, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.executemany(sql, rows[start:start + BATCH_SIZE])
+
+
+def export_run(db_path, airport, program_tables, summary, attribution,
+               ffs_path=None):
+    """Insert the outputs of one run in a single transaction.
+
+    program_tables maps a program name to its monthly metrics table (with
+    a year_month column), summary is the one-row summarize_benefits()
+    table and attribution has gufi, year_month and program columns.
+    Months are stored as zero-padded "YYYY-MM".
+    Returns the run_id of the new run.
+    """
+    conn = connect(db_path)
+    try:
+        with conn:
+            run_id = conn.execute(
+                    "INSERT INTO runs (run_time, airport, ffs_path) "
+                    "VALUES (?, ?, ?)",
+                    (dt.datetime.now().isoformat(), airport,
+                     ffs_path)).lastrowid
+
+            for program, table in program_tables.items():
+                if table is None:
+                    continue
+                long = table.melt(id_vars=["year_month"],
+                                  var_name="metric", value_name="value")
+                _insert_batches(
+                        conn,
+                        "INSERT INTO program_metrics VALUES (?, ?, ?, ?, ?, ?)",
+                        [(run_id, airport, program, year_month, metric, value)
+                         for year_month, metric, value in zip(
+                             long["year_month"].map(sortable_month).tolist(),
+                             long["metric"].tolist(),
+                             long["value"].astype(float).tolist())])
+
+            _insert_batches(
+                    conn,
+                    "INSERT INTO summary_metrics VALUES (?, ?, ?, ?)",
+                    [(run_id, airport, metric, float(value))
+                     for metric, value in summary.iloc[0].items()])
+
+            months = attribution["year_month"].map(sortable_month)
+            _insert_batches(
+                    conn,
+                    "INSERT INTO flight_attribution VALUES (?, ?, ?, ?, ?)",
+                    [(run_id, airport, program, year_month, gufi)
+                     for program, year_month, gufi in zip(
+                         attribution["program"].tolist(),
+                         months.tolist(),
+                         attribution["gufi"].astype(str).tolist())])
+    finally:
+        conn.close()
+
+    return run_id
+
+
+def program_history(db_path, airport, program, metric=None):
+    """Monthly values of a program's metrics across all stored runs."""
+    query = ("SELECT r.run_id, r.run_time, m.year_month, m.metric, m.value "
+             "FROM program_metrics m JOIN runs r ON r.run_id = m.run_id "
+             "WHERE m.airport = ? AND m.program = ?")
+    params = [airport, program]
+    if metric is not None:
+        query += " AND m.metric = ?"
+        params.append(metric)
+    query += " ORDER BY r.run_id, m.year_month"
+
+    conn = connect(db_path)
+    try:
+        return pd.read_sql_query(query, conn, params=params)
+    finally:
+        conn.close()
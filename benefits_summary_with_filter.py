@@ -1,9 +1,21 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
+import fnmatch
 import glob
+import gzip
+import hashlib
+import json
 import os.path
 import logging
+import re
+import shutil
+import multiprocessing
+import pickle
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
 import datetime as dt
@@ -11,7 +23,13 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import mops_emission as mem
+import benefits_profile as bprof
+import benefits_store as bstore
 from sklearn import linear_model
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -20,71 +38,207 @@ mem.init_emission("fuel_and_emission_table.csv")
 
 DEFAULT_AIRPORT = "KCLT"
 DEFAULT_FFS_VERSION = "1.0"
+DEFAULT_IO_THREADS = 4
+
+CHART_PROCESSES = 2
+CHART_MANIFEST = "chart_hashes.json"
+CHART_FILES = {
+    "plot_surface_metering_benefits":"hold_estimated_savings_{}.png",
+    "plot_apreq_benefits":"apreq_estimated_savings_{}.png"}
+
+FLIGHTS_CACHE = "flights.pkl"
+#### Bump when modify_data or build_program_bitmaps change what is cached
+#### in FLIGHTS_CACHE
+FLIGHTS_CACHE_VERSION = 3
+EMISSIONS_CACHE = "emissions.pkl"
+
+FFS_DATE_COLUMNS = ["time_at_initial_apreq",
+                    "apreq_initial",
+                    "apreq_final",
+                    "departure_stand_actual_time",
+                    "pilot_ready_time"]
 
 KGS_TO_LBS = 2.20462
 GMS_TO_LBS = KGS_TO_LBS/1000
 LBS_TO_METRIC_TONS = 1/(KGS_TO_LBS*1000)
 METRIC_TONS_CO2_TO_URBAN_TREES = 1/0.039
-
-def main(ffs_path, ffs_version, airport):
-    flight_list_included = []
-
+ONE_DAY_SECONDS = 86400
+
+#### Departure phases are delimited by stand, movement area and runway times
+DEPARTURE_PHASE_TIMES = ["departure_stand_actual_time",
+                         "departure_movement_area_actual_time",
+                         "departure_runway_actual_time"]
+#### Unimpeded phase time is this quantile of the monthly actual phase times
+UNIMPEDED_PHASE_QUANTILE = 0.1
+#### Same order as the columns returned by mops_emission
+EMISSION_PHASES = [("taxi", "taxi"),
+                   ("ramp", "ramp"),
+                   ("movement_area", "movement area")]
+EMISSION_SPECIES = [("fuel", "fuel burned", KGS_TO_LBS),
+                    ("co", "CO emitted", GMS_TO_LBS),
+                    ("co2", "CO2 emitted", KGS_TO_LBS),
+                    ("hc", "HC emitted", GMS_TO_LBS),
+                    ("nox", "NOX emitted", GMS_TO_LBS)]
+
+#### Bitmap predicates selecting each program's flights. Flights are
+#### claimed in the order GS, EDCT, APREQ, METER, which also drops flights
+#### without a gufi. IDAC flights are not claimed, so their selection has
+#### to exclude those itself.
+PROGRAM_PREDICATES = {
+    "GS":["valid_date", "gs"],
+    "EDCT":["valid_date", "edct"],
+    "APREQ":["valid_date", "neg_at_gate", "reasonable_hold"],
+    "METER":["valid_date", "metered"],
+    "IDAC":["valid_date", "has_gufi", "idac_savings", "all_idac"]}
+PROGRAM_CLAIM_ORDER = ["GS", "EDCT", "APREQ", "METER"]
+
+#### Per-flight (hold time, seconds per hour, fuel, CO2) columns summed
+#### into each program's metrics
+PROGRAM_BENEFIT_COLUMNS = {
+    "GS":("effective_gate_hold", 3600,
+          "hold_savings_fuel", "hold_savings_co2"),
+    "EDCT":("effective_gate_hold", 3600,
+            "hold_savings_fuel", "hold_savings_co2"),
+    "APREQ":("effective_gate_hold", 3600,
+             "hold_savings_fuel", "hold_savings_co2"),
+    "METER":("actual_gate_hold", 60,
+             "gate_hold_fuel_savings", "gate_hold_co2_savings"),
+    "IDAC":("negotiation_savings", 3600,
+            "IDAC_savings_fuel", "IDAC_savings_co2")}
+
+#### Quick-look sampling stratifies files on the month in their name
+FILE_MONTH_PATTERN = re.compile(r"(\d{4})[-_]?(\d{2})[-_]?\d{2}")
+SAMPLED_METRICS = ["flights", "hold_hours", "fuel_pounds", "co2_pounds",
+                   "urban_trees"]
+SAMPLE_CONFIDENCE_Z = 1.96
+
+#### Per-flight emission columns computed from each hold-time field
+HOLD_EMISSION_COLUMNS = {
+    "effective_gate_hold":["hold_savings_fuel",
+                           "hold_savings_co",
+                           "hold_savings_co2",
+                           "hold_savings_hc",
+                           "hold_savings_nox"],
+    "negotiation_savings":["IDAC_savings_fuel",
+                           "IDAC_savings_co",
+                           "IDAC_savings_co2",
+                           "IDAC_savings_hc",
+                           "IDAC_savings_nox"]}
+
+#### Columns program_metrics() and flight_attribution() read once claims
+#### and hold emissions are resolved, the ones shared with the workers of
+#### partitioned_program_metrics()
+PARTITION_COLUMNS = (["gufi",
+                      "year_month",
+                      "aircraft_type",
+                      "departure_aerodrome_icao_name",
+                      "effective_gate_hold",
+                      "negotiation_savings",
+                      "hold_indicator",
+                      "actual_gate_hold",
+                      "gate_hold_fuel_savings",
+                      "gate_hold_co_savings",
+                      "gate_hold_co2_savings",
+                      "gate_hold_hc_savings",
+                      "gate_hold_nox_savings"] +
+                     DEPARTURE_PHASE_TIMES +
+                     [column for columns in HOLD_EMISSION_COLUMNS.values()
+                      for column in columns])
+
+#### Data-quality reason codes, bit i of a flight's reason mask is code i
+QUARANTINE_REASONS = ["NAT_STAND_TIME",
+                      "NAT_READY_TIME",
+                      "NEGATIVE_GATE_HOLD",
+                      "OVERDAY_GATE_HOLD",
+                      "OVERDAY_NEGOTIATION",
+                      "UNKNOWN_AIRCRAFT_TYPE",
+                      "HOLD_WITHOUT_METERING",
+                      "HOLD_FLAG_MISMATCH"]
+
+def main(ffs_path, ffs_version, airport, jobs=1,
+         io_threads=DEFAULT_IO_THREADS, cache_dir=None, db=None,
+         sample=None, sample_seed=None):
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
     logger.addHandler(ch)
 
-    logger.info("Begin loading data at {}".format(dt.datetime.now()))
-    df0 = load_ffs_data(ffs_path, airport, ffs_version)
-    logger.info("Finish loading data at {}".format(dt.datetime.now()))
-
-    logger.info("Begin modifying data at {}".format(dt.datetime.now()))
-    df1 = modify_data(df0)
-    logger.info("Finish modifying data at {}".format(dt.datetime.now()))
-
     outputSuffix = dt.datetime.now().strftime("%Y%m%d")
 
-    logger.info("Begin computing APREQ-all metrics at {}".format(
-            dt.datetime.now()))
-
-
-    #### compute GS first
+    if sample is not None:
+        logger.info("Begin computing sampled quick-look at {}".format(
+                dt.datetime.now()))
+        quicklook = sampled_benefits(ffs_path, ffs_version, airport, sample,
+                                     io_threads, sample_seed)
+        quicklook.to_csv("quicklook_benefits_{}.csv".format(
+                outputSuffix), index=False)
+        logger.info("Finish computing sampled quick-look at {}".format(
+                dt.datetime.now()))
+        return
+
+    flights_key = None
+    cached = None
+    if cache_dir:
+        flights_key = flights_cache_key(ffs_path, ffs_version, airport)
+        cached = read_cache(os.path.join(cache_dir, FLIGHTS_CACHE),
+                            flights_key)
+
+    if cached is not None:
+        logger.info("Using cached flights from {}".format(cache_dir))
+        [df1, bitmaps] = cached
+    else:
+        logger.info("Begin loading data at {}".format(dt.datetime.now()))
+        df0 = load_ffs_data(ffs_path, airport, ffs_version, io_threads)
+        logger.info("Finish loading data at {}".format(dt.datetime.now()))
+
+        logger.info("Begin modifying data at {}".format(dt.datetime.now()))
+        df1 = modify_data(df0)
+        logger.info("Finish modifying data at {}".format(dt.datetime.now()))
+
+        bitmaps = build_program_bitmaps(df1)
+        if cache_dir:
+            write_cache(os.path.join(cache_dir, FLIGHTS_CACHE), flights_key,
+                        [df1, bitmaps])
+
+    ##### Not cached, UNKNOWN_AIRCRAFT_TYPE depends on the emission table
+    logger.info("Begin validating data at {}".format(dt.datetime.now()))
+    quarantine = quarantine_flights(df1, validate_data(df1))
+    logger.info("Quarantined {} flights".format(len(quarantine)))
+    logger.info("Finish validating data at {}".format(dt.datetime.now()))
+    quarantine.to_csv("quarantine_flights_{}.csv".format(
+            outputSuffix), index=False)
 
-    logger.info("Begin computing GS-all metrics at {}".format(
+    logger.info("Begin computing flight emissions at {}".format(
             dt.datetime.now()))
-    ######### GS metrics
-    [gs_all,flight_list_included] = gs_metrics_by_group(df1, None,flight_list_included)
-    ######### GS metrics
-    gs_all.to_csv("gs_benefits_airport_wide_{}.csv".format(
-            outputSuffix), index=False)
-    logger.info("Finish computing GS-all metrics at {}".format(
+    df1 = df1.assign(**flight_emissions(df1, cache_dir))
+    logger.info("Finish computing flight emissions at {}".format(
             dt.datetime.now()))
 
+    if jobs > 1:
+        logger.info("Begin computing month-partitioned metrics with {} "
+                    "processes at {}".format(jobs, dt.datetime.now()))
+        [gs_all, edct_all, apreq_all, meter_all, excess_all,
+         attribution] = partitioned_program_metrics(df1, airport, bitmaps,
+                                                    jobs)
+        logger.info("Finish computing month-partitioned metrics at {}".format(
+                dt.datetime.now()))
+    else:
+        claims = new_claims(bitmaps)
+        [gs_all, edct_all, apreq_all, meter_all, excess_all] = (
+                program_metrics(df1, airport, bitmaps, claims))
+        attribution = flight_attribution(df1, bitmaps, claims)
 
-    #### compute general EDCT
-
-
-    logger.info("Begin computing EDCT-all metrics at {}".format(
-            dt.datetime.now()))
-    ######### EDCT metrics
-    [edct_all,flight_list_included] = edct_metrics_by_group(df1, None, flight_list_included)
-    ######### EDCT metrics
+    gs_all.to_csv("gs_benefits_airport_wide_{}.csv".format(
+            outputSuffix), index=False)
     edct_all.to_csv("edct_benefits_airport_wide_{}.csv".format(
             outputSuffix), index=False)
-    logger.info("Finish computing EDCT-all metrics at {}".format(
-            dt.datetime.now()))
-
-
-
-    logger.info("Begin computing APREQ-all metrics at {}".format(
-             dt.datetime.now()))
-    ######### APREQ metrics
-    [apreq_all,flight_list_included] = apreq_metrics_by_group(df1, None,flight_list_included)
-    ######### APREQ metrics
     apreq_all.to_csv("apreq_benefits_airport_wide_{}.csv".format(
             outputSuffix), index=False)
-    plot_apreq_benefits(apreq_all, outputSuffix)
-    logger.info("Finish computing APREQ-all metrics at {}".format(
-            dt.datetime.now()))
+    meter_all.to_csv("hold_benefits_airport_wide_{}.csv".format(
+            outputSuffix), index=False)
+
+    if excess_all is not None:
+        excess_all.to_csv("excess_emissions_airport_wide_{}.csv".format(
+                outputSuffix), index=False)
 
     # logger.info("Begin computing APREQ-AAL metrics at {}".format(
     #         dt.datetime.now()))
@@ -102,17 +256,6 @@ def main(ffs_path, ffs_version, airport):
     # logger.info("Finish computing APREQ-regional metrics at {}".format(
     #         dt.datetime.now()))
 
-    logger.info("Begin computing metering-all metrics at {}".format(
-            dt.datetime.now()))
-    ######### Meter metrics
-    [meter_all,flight_list_included] = metering_metrics_by_group(df1, None, airport,flight_list_included)
-    ######### Meter metrics
-    meter_all.to_csv("hold_benefits_airport_wide_{}.csv".format(
-            outputSuffix), index=False)
-    plot_surface_metering_benefits(meter_all, outputSuffix)
-    logger.info("Finish computing metering-all metrics at {}".format(
-            dt.datetime.now()))
-
     # logger.info("Begin computing metering-AAL metrics at {}".format(
     #         dt.datetime.now()))
     # meter_aal = metering_metrics_by_group(df1, "aal_mainline", airport)
@@ -165,14 +308,224 @@ def main(ffs_path, ffs_version, airport):
     # logger.info("Finish computing GS-regional metrics at {}".format(
     #         dt.datetime.now()))
 
-    logger.info("Begin computing summary of benefits at {}".format(
+    with ProcessPoolExecutor(max_workers=CHART_PROCESSES) as chart_pool:
+        [chart_manifest, pending_charts] = submit_charts(
+                chart_pool,
+                [(plot_apreq_benefits, apreq_all),
+                 (plot_surface_metering_benefits, meter_all)],
+                outputSuffix)
+
+        logger.info("Begin computing summary of benefits at {}".format(
+                dt.datetime.now()))
+        summary = summarize_benefits(apreq_all, meter_all, edct_all, gs_all)
+        summary.to_csv("summary_benefits_metrics_{}.csv".format(
+                outputSuffix), index=False)
+        logger.info("Finish computing summary of benefits at {}".format(
+                dt.datetime.now()))
+
+        if db:
+            logger.info("Begin exporting to {} at {}".format(
+                    db, dt.datetime.now()))
+            run_id = bstore.export_run(
+                    db, airport,
+                    {"GS":gs_all,
+                     "EDCT":edct_all,
+                     "APREQ":apreq_all,
+                     "METER":meter_all,
+                     "EXCESS":excess_all},
+                    summary, attribution, ffs_path)
+            logger.info("Finish exporting run {} at {}".format(
+                    run_id, dt.datetime.now()))
+
+        wait_for_charts(chart_manifest, pending_charts)
+
+#### Runs the four program stages (claiming flights in order GS, EDCT,
+#### APREQ, metering) and the excess emission stage on df
+def program_metrics(df, airport, bitmaps=None, claims=None,
+                    debug_output=True):
+    flight_list_included = []
+    if bitmaps is not None and claims is None:
+        claims = new_claims(bitmaps)
+
+    #### compute GS first
+
+    logger.info("Begin computing GS-all metrics at {}".format(
             dt.datetime.now()))
-    summary = summarize_benefits(apreq_all, meter_all, edct_all, gs_all)
-    summary.to_csv("summary_benefits_metrics_{}.csv".format(
-            outputSuffix), index=False)
-    logger.info("Finish computing summary of benefits at {}".format(
+    ######### GS metrics
+    [gs_all,flight_list_included] = gs_metrics_by_group(df, None,flight_list_included, bitmaps, claims)
+    logger.info("Finish computing GS-all metrics at {}".format(
+            dt.datetime.now()))
+
+
+    #### compute general EDCT
+
+
+    logger.info("Begin computing EDCT-all metrics at {}".format(
+            dt.datetime.now()))
+    ######### EDCT metrics
+    [edct_all,flight_list_included] = edct_metrics_by_group(df, None, flight_list_included, bitmaps, claims)
+    logger.info("Finish computing EDCT-all metrics at {}".format(
+            dt.datetime.now()))
+
+
+
+    logger.info("Begin computing APREQ-all metrics at {}".format(
+             dt.datetime.now()))
+    ######### APREQ metrics
+    [apreq_all,flight_list_included] = apreq_metrics_by_group(df, None,flight_list_included, bitmaps, claims)
+    logger.info("Finish computing APREQ-all metrics at {}".format(
+            dt.datetime.now()))
+
+    logger.info("Begin computing metering-all metrics at {}".format(
+            dt.datetime.now()))
+    ######### Meter metrics
+    [meter_all,flight_list_included] = metering_metrics_by_group(df, None, airport,flight_list_included, bitmaps, claims, debug_output)
+    logger.info("Finish computing metering-all metrics at {}".format(
             dt.datetime.now()))
 
+    excess_all = None
+    if all(c in df.columns for c in DEPARTURE_PHASE_TIMES):
+        logger.info("Begin computing excess emission metrics at {}".format(
+                dt.datetime.now()))
+        excess_all = excess_emission_metrics_by_group(df, None, airport)
+        logger.info("Finish computing excess emission metrics at {}".format(
+                dt.datetime.now()))
+    else:
+        logger.warning("Skipping excess emission metrics, missing one of "
+                       "columns {}".format(DEPARTURE_PHASE_TIMES))
+
+    return [gs_all, edct_all, apreq_all, meter_all, excess_all]
+
+#### A gufi can have flights in several months, so claims are resolved
+#### once over all flights, here, as are the hold emissions before. The
+#### PARTITION_COLUMNS are copied once, sorted by month, into a shared
+#### memory block, which is cut into one run of whole months per job with
+#### about as many flights each. Every run is handed to a worker as a row
+#### range with its slice of the bitmaps and claims. Only the per-month
+#### work, program aggregation and excess phase emissions, runs in
+#### parallel.
+def partitioned_program_metrics(df, airport, bitmaps, jobs):
+    claims = resolve_claims(bitmaps, new_claims(bitmaps))
+
+    month_codes, months = pd.factorize(df["year_month"], sort=True)
+    order = np.argsort(month_codes, kind="stable")
+    order = order[df["year_month"].values[order] != "nan-nan"]
+    if len(order) == 0:
+        return (program_metrics(df, airport, bitmaps, claims,
+                                debug_output=False) +
+                [flight_attribution(df, bitmaps, claims)])
+    month_stops = np.cumsum(np.bincount(month_codes[order],
+                                        minlength=len(months)))
+    bounds = np.unique(np.concatenate([
+            [0],
+            month_stops[np.searchsorted(
+                month_stops, len(order) * np.arange(1, jobs) / jobs)],
+            [len(order)]]))
+
+    shm, layout = share_columns(df, PARTITION_COLUMNS, order)
+    try:
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(
+                    _partition_program_metrics,
+                    [(shm.name, layout, start, stop, airport,
+                      slice_bitmaps(bitmaps, order[start:stop]),
+                      slice_claims(bitmaps, claims, order[start:stop]))
+                     for start, stop in zip(bounds[:-1], bounds[1:])])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    merged = []
+    for stage in zip(*results):
+        stage = [r for r in stage if r is not None]
+        if stage:
+            merged.append(pd.concat(stage, ignore_index=True).
+                          sort_values("year_month").
+                          reset_index(drop=True))
+        else:
+            merged.append(None)
+
+    return merged
+
+def _partition_program_metrics(args):
+    shm_name, layout, start, stop, airport, bitmaps, claims = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        df = shared_frame(shm.buf, layout, start, stop)
+        results = (program_metrics(df, airport, bitmaps, claims,
+                                   debug_output=False) +
+                   [flight_attribution(df, bitmaps, claims)])
+        ##### The frame views the block, release it before closing
+        del df
+    finally:
+        shm.close()
+
+    return results
+
+#### Copies the columns of df, rows taken in order, into one shared memory
+#### block as numpy arrays. Columns without a numpy dtype are stored as
+#### factorize() codes, with their uniques in the block too when they are
+#### strings. Returns the block and the layout shared_frame() reads.
+def share_columns(df, columns, order):
+    layout = []
+    arrays = []
+    size = 0
+    for column in columns:
+        if column not in df.columns:
+            continue
+        values = df[column]
+        uniques = None
+        if (isinstance(values.dtype, np.dtype) and
+                values.dtype.kind in "biufmM"):
+            parts = {"values":values.to_numpy()[order]}
+        else:
+            codes, uniques = pd.factorize(values)
+            parts = {"codes":codes[order]}
+            if pd.api.types.infer_dtype(uniques) == "string":
+                parts["uniques"] = np.asarray(uniques, dtype=str)
+                uniques = None
+            else:
+                uniques = np.asarray(uniques, dtype=object)
+
+        specs = {}
+        for name, array in parts.items():
+            offset = (size + 7) // 8 * 8
+            specs[name] = (array.dtype.str, array.shape, offset)
+            arrays.append((array, offset))
+            size = offset + array.nbytes
+        layout.append((column, values.dtype, specs, uniques))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for array, offset in arrays:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf,
+                   offset=offset)[...] = array
+
+    return [shm, layout]
+
+#### Frame of rows start:stop of a share_columns() block, the numpy
+#### columns are read-only views of the block
+def shared_frame(buf, layout, start, stop):
+    columns = {}
+    for column, dtype, specs, uniques in layout:
+        parts = {}
+        for name, (array_dtype, shape, offset) in specs.items():
+            parts[name] = np.ndarray(shape, dtype=np.dtype(array_dtype),
+                                     buffer=buf, offset=offset)
+            parts[name].flags.writeable = False
+
+        if "values" in parts:
+            columns[column] = parts["values"][start:stop]
+            continue
+        if uniques is None:
+            uniques = parts["uniques"]
+        codes = parts["codes"][start:stop]
+        idx = codes >= 0
+        values = np.full(len(codes), np.nan, dtype=object)
+        values[idx] = uniques[codes[idx]].astype(object)
+        columns[column] = pd.array(values, dtype=dtype)
+
+    return pd.DataFrame(columns, copy=False)
+
 #TODO: clean up this function
 def summarize_benefits(df_apreq, df_hold, df_edct, df_gs):
     df_summary = pd.DataFrame()
@@ -278,20 +631,29 @@ def summarize_benefits(df_apreq, df_hold, df_edct, df_gs):
 
     return df_summary
 
-def edct_metrics_by_group(df, group, flight_list):
-    if group:
-        idx_group = df["flight_category"] == group
+def edct_metrics_by_group(df, group, flight_list, bitmaps=None, claims=None):
+    if bitmaps is not None:
+        if claims is None:
+            claims = new_claims(bitmaps)
+        idx_edct = bitmap_select(bitmaps, PROGRAM_PREDICATES["EDCT"], group)
+        print('EDCT pre filter')
+        print(idx_edct.sum())
+        ##### Filter out flights found previously
+        df_edct = df[claim_flights(bitmaps, claims, idx_edct, "EDCT")]
     else:
-        idx_group = df["gufi"].notnull()
-
-    idx_date = df["year_month"] != "nan-nan"
-    idx_edct = df["edct_at_ready"].notnull()
-
-    df_edct = df[idx_group & idx_date & idx_edct] 
-    print('EDCT pre filter')
-    print(len(df_edct))
-    ##### Filter out flights found previously
-    df_edct = df_edct[~df_edct['gufi'].isin(flight_list)]
+        if group:
+            idx_group = df["flight_category"] == group
+        else:
+            idx_group = df["gufi"].notnull()
+
+        idx_date = df["year_month"] != "nan-nan"
+        idx_edct = df["edct_at_ready"].notnull()
+
+        df_edct = df[idx_group & idx_date & idx_edct] 
+        print('EDCT pre filter')
+        print(len(df_edct))
+        ##### Filter out flights found previously
+        df_edct = df_edct[~df_edct['gufi'].isin(flight_list)]
     print('EDCT post filter')
     print(len(df_edct))
     df_temp = df_edct[df_edct['effective_gate_hold']>0]
@@ -305,13 +667,13 @@ def edct_metrics_by_group(df, group, flight_list):
              "hold_savings_co",
              "hold_savings_co2",
              "hold_savings_hc",
-             "hold_savings_nox"]] = df_edct.apply(
-                     calc_emissions, axis=1, args=["effective_gate_hold"])
+             "hold_savings_nox"]] = hold_emissions(
+                     df_edct, "effective_gate_hold")
 
     edct_metrics = (
             df_edct.groupby(["year_month"]).agg(
             {"gufi":"count",
-             "effective_gate_hold":lambda x: sum(x)/3600,
+             "effective_gate_hold":lambda x: np.nansum(x)/3600,
              "hold_savings_fuel":lambda x: np.nansum(x)*KGS_TO_LBS,
              "hold_savings_co":lambda x: np.nansum(x)*GMS_TO_LBS,
              "hold_savings_co2":lambda x: np.nansum(x)*KGS_TO_LBS,
@@ -335,20 +697,29 @@ def edct_metrics_by_group(df, group, flight_list):
 
     return [edct_metrics,flight_list]
 
-def gs_metrics_by_group(df, group, flight_list):
-    if group:
-        idx_group = df["flight_category"] == group
+def gs_metrics_by_group(df, group, flight_list, bitmaps=None, claims=None):
+    if bitmaps is not None:
+        if claims is None:
+            claims = new_claims(bitmaps)
+        idx_gs = bitmap_select(bitmaps, PROGRAM_PREDICATES["GS"], group)
+        print('GS pre filter')
+        print(idx_gs.sum())
+        ##### Filter out flights found previously
+        df_gs = df[claim_flights(bitmaps, claims, idx_gs, "GS")]
     else:
-        idx_group = df["gufi"].notnull()
-
-    idx_date = df["year_month"] != "nan-nan"
-    idx_gs = df["ground_stop_restriction_ids_present"] == True
-
-    df_gs = df[idx_group & idx_date & idx_gs]
-    print('GS pre filter')
-    print(len(df_gs))
-    ##### Filter out flights found previously
-    df_gs = df_gs[~df_gs['gufi'].isin(flight_list)]
+        if group:
+            idx_group = df["flight_category"] == group
+        else:
+            idx_group = df["gufi"].notnull()
+
+        idx_date = df["year_month"] != "nan-nan"
+        idx_gs = df["ground_stop_restriction_ids_present"] == True
+
+        df_gs = df[idx_group & idx_date & idx_gs]
+        print('GS pre filter')
+        print(len(df_gs))
+        ##### Filter out flights found previously
+        df_gs = df_gs[~df_gs['gufi'].isin(flight_list)]
     print('GS post filter')
     print(len(df_gs))
     df_temp = df_gs[df_gs['effective_gate_hold']>0]
@@ -364,14 +735,14 @@ def gs_metrics_by_group(df, group, flight_list):
              "hold_savings_co",
              "hold_savings_co2",
              "hold_savings_hc",
-             "hold_savings_nox"]] = df_gs.apply(
-                     calc_emissions, axis=1, args=["effective_gate_hold"])
+             "hold_savings_nox"]] = hold_emissions(
+                     df_gs, "effective_gate_hold")
     logger.debug("Finish computing emissions at {}".format(dt.datetime.now()))
 
     gs_metrics = (
             df_gs.groupby(["year_month"]).agg(
             {"gufi":"count",
-             "effective_gate_hold":lambda x: sum(x)/3600,
+             "effective_gate_hold":lambda x: np.nansum(x)/3600,
              "hold_savings_fuel":lambda x: np.nansum(x)*KGS_TO_LBS,
              "hold_savings_co":lambda x: np.nansum(x)*GMS_TO_LBS,
              "hold_savings_co2":lambda x: np.nansum(x)*KGS_TO_LBS,
@@ -403,7 +774,7 @@ def plot_surface_metering_benefits(df_hold, decorator):
                reset_index())
     co2 = np.array(
             df_hold["CO2 saved by surface metering gate holds (pounds)"])
-    plt.figure(figsize=(30,8))
+    fig = plt.figure(figsize=(30,8))
     x_vec = np.arange(len(co2))
     plt.bar(x_vec, co2/float(1000),
             color="green", alpha=0.5, edgecolor="black")
@@ -414,7 +785,11 @@ def plot_surface_metering_benefits(df_hold, decorator):
               fontsize=40)
     ax = plt.gca()
     ax.yaxis.grid(True)
-    plt.savefig("hold_estimated_savings_{}.png".format(decorator))
+    filename = CHART_FILES["plot_surface_metering_benefits"].format(decorator)
+    fig.savefig(filename)
+    plt.close(fig)
+
+    return filename
 
 def plot_apreq_benefits(df_apreq, decorator):
     df_apreq = df_apreq.sort_values("year_month").reset_index()
@@ -422,7 +797,7 @@ def plot_apreq_benefits(df_apreq, decorator):
             fuel_per_apreq=df_apreq["Fuel saved by gate holds of flights with APREQ negotiated at gate (pounds)"]
                 / df_apreq["Count of flights with first APREQ negotiated at gate"])
     fuel_per_apreq = np.array(df_apreq["fuel_per_apreq"])
-    plt.figure(figsize=(12,10))
+    fig = plt.figure(figsize=(12,10))
     x_vec = np.arange(len(fuel_per_apreq))
     plt.plot(x_vec, fuel_per_apreq, linewidth=10, color="blue", alpha=0.6)
     plt.plot(x_vec, fuel_per_apreq,
@@ -444,25 +819,90 @@ def plot_apreq_benefits(df_apreq, decorator):
     y2 = (len(x_vec)-1) * slope + y_intercept
     plt.plot([0,len(x_vec)-1], [y_intercept, y2 ],
               linestyle="-.", linewidth=6, color="red")
-    plt.savefig("apreq_estimated_savings_{}.png".format(decorator))
-
-def metering_metrics_by_group(df, group, airport,flight_list):
-    if group:
-        idx_group = df["flight_category"] == group
+    filename = CHART_FILES["plot_apreq_benefits"].format(decorator)
+    fig.savefig(filename)
+    plt.close(fig)
+
+    return filename
+
+#### Charts are rendered in worker processes. A chart is skipped, and the
+#### previous image reused, when the hash of its input data matches the
+#### one recorded in CHART_MANIFEST for its last rendering.
+def chart_hash(plot_func, df):
+    digest = hashlib.sha256(plot_func.__name__.encode("utf-8"))
+    digest.update("\x1f".join(str(c) for c in df.columns).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def _render_chart(plot_func, df, decorator):
+    try:
+        return plot_func(df, decorator)
+    finally:
+        plt.close("all")
+
+def submit_charts(executor, charts, decorator):
+    manifest = {}
+    if os.path.isfile(CHART_MANIFEST):
+        with open(CHART_MANIFEST) as f:
+            manifest = json.load(f)
+
+    pending = []
+    for plot_func, df in charts:
+        name = plot_func.__name__
+        digest = chart_hash(plot_func, df)
+        filename = CHART_FILES[name].format(decorator)
+        previous = manifest.get(name)
+        if (previous and previous["hash"] == digest and
+                os.path.isfile(previous["path"])):
+            if os.path.abspath(previous["path"]) != os.path.abspath(filename):
+                shutil.copyfile(previous["path"], filename)
+            logger.info("Chart {} unchanged, not rendering".format(filename))
+            continue
+        pending.append((name, digest,
+                        executor.submit(_render_chart, plot_func, df,
+                                        decorator)))
+
+    return [manifest, pending]
+
+def wait_for_charts(manifest, pending):
+    for name, digest, future in pending:
+        filename = future.result()
+        manifest[name] = {"hash":digest, "path":filename}
+        logger.info("Rendered chart {}".format(filename))
+
+    with open(CHART_MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def metering_metrics_by_group(df, group, airport,flight_list, bitmaps=None,
+                              claims=None, debug_output=True):
+    if bitmaps is not None:
+        if claims is None:
+            claims = new_claims(bitmaps)
+        idx_meter = bitmap_select(bitmaps, PROGRAM_PREDICATES["METER"], group)
+        print('metering pre filter')
+        print(idx_meter.sum())
+        ##### Filter out flights found previously
+        idx_unclaimed = claim_flights(bitmaps, claims, idx_meter, "METER")
+        debug_df = df[idx_meter & ~idx_unclaimed]
+        metrics = df[idx_unclaimed]
     else:
-        idx_group = df["gufi"].notnull()
-
-    idx_date = df["year_month"] != "nan-nan"
-    idx_meter = df["metered_indicator"] == True
-
-    metrics = df[idx_group & idx_date & idx_meter]
-    print('metering pre filter')
-    print(len(metrics))
-    ##### Filter out flights found previously
-    debug_df = metrics[metrics['gufi'].isin(flight_list)]
-    debug_df.to_csv('surface_metered_flights_filtered_out.csv',index=False)
-    metrics = metrics[~metrics['gufi'].isin(flight_list)]
-    metrics.to_csv('debug_surface_metered_flights.csv')
+        if group:
+            idx_group = df["flight_category"] == group
+        else:
+            idx_group = df["gufi"].notnull()
+
+        idx_date = df["year_month"] != "nan-nan"
+        idx_meter = df["metered_indicator"] == True
+
+        metrics = df[idx_group & idx_date & idx_meter]
+        print('metering pre filter')
+        print(len(metrics))
+        ##### Filter out flights found previously
+        debug_df = metrics[metrics['gufi'].isin(flight_list)]
+        metrics = metrics[~metrics['gufi'].isin(flight_list)]
+    if debug_output:
+        debug_df.to_csv('surface_metered_flights_filtered_out.csv',index=False)
+        metrics.to_csv('debug_surface_metered_flights.csv')
     print('metering post filter')
     print(len(metrics))
     temp_metrics = metrics[metrics['hold_indicator']==True]
@@ -499,25 +939,31 @@ def metering_metrics_by_group(df, group, airport,flight_list):
 
     return [metrics,flight_list]
 
-def apreq_metrics_by_group(df, group,flight_list):
-    idx_idac_savings = df["apreq_final"] < df["apreq_initial"]
-    idx_all_idac = ((df["apreq_initial_source"] == "IDAC") &
-                   (df["apreq_final_source"] == "IDAC"))
-    if group:
-        idx_group = df["flight_category"] == group
+def apreq_metrics_by_group(df, group,flight_list, bitmaps=None, claims=None):
+    if bitmaps is not None:
+        if claims is None:
+            claims = new_claims(bitmaps)
+        df_idac = df[bitmap_select(
+                bitmaps, PROGRAM_PREDICATES["IDAC"], group)]
     else:
-        idx_group = df["gufi"].notnull()
+        idx_idac_savings = df["apreq_final"] < df["apreq_initial"]
+        idx_all_idac = ((df["apreq_initial_source"] == "IDAC") &
+                       (df["apreq_final_source"] == "IDAC"))
+        if group:
+            idx_group = df["flight_category"] == group
+        else:
+            idx_group = df["gufi"].notnull()
 
-    idx_neg_at_gate = (
-            df["surface_flight_state_at_initial_apreq"] == "SCHEDULED")
-    idx_reasonable_holds = (df["effective_gate_hold"] <= 1800)
+        idx_neg_at_gate = (
+                df["surface_flight_state_at_initial_apreq"] == "SCHEDULED")
+        idx_reasonable_holds = (df["effective_gate_hold"] <= 1800)
 
-    idx_date = df["year_month"] != "nan-nan"
+        idx_date = df["year_month"] != "nan-nan"
 
-    df_idac = df[idx_group &
-                 idx_idac_savings &
-                 idx_all_idac &
-                 idx_date]
+        df_idac = df[idx_group &
+                     idx_idac_savings &
+                     idx_all_idac &
+                     idx_date]
 
     #### DONT FILTER FLIGHTS FROM RENEGOTIATION SAVINGS
     # print(len(df_idac))
@@ -536,13 +982,13 @@ def apreq_metrics_by_group(df, group,flight_list):
              "IDAC_savings_co",
              "IDAC_savings_co2",
              "IDAC_savings_hc",
-             "IDAC_savings_nox"]] = df_idac.apply(
-                         calc_emissions, axis=1, args=["negotiation_savings"])
+             "IDAC_savings_nox"]] = hold_emissions(
+                     df_idac, "negotiation_savings")
 
     idac_metrics = (
             df_idac.groupby(["year_month"]).agg(
             {"gufi":"count",
-             "negotiation_savings":lambda x: sum(x)/3600,
+             "negotiation_savings":lambda x: np.nansum(x)/3600,
              "IDAC_savings_fuel":lambda x: np.nansum(x)*KGS_TO_LBS,
              "IDAC_savings_co":lambda x: np.nansum(x)*GMS_TO_LBS,
              "IDAC_savings_co2":lambda x: np.nansum(x)*KGS_TO_LBS,
@@ -575,16 +1021,23 @@ def apreq_metrics_by_group(df, group,flight_list):
                 "Urban trees saved by IDAC APREQ negotiation"},
             inplace=True)
 
-    hold_metrics_df = df[idx_group &
-                         idx_neg_at_gate &
-                         idx_reasonable_holds &
-                         idx_date]
-
     ##### FILTER EDCT / GS that might also have APREQ and gate hold
-    print('APREQ gate hold pre filter')
-    print(len(hold_metrics_df))
-    ##### Filter out flights found previously
-    hold_metrics_df = hold_metrics_df[~hold_metrics_df['gufi'].isin(flight_list)]
+    if bitmaps is not None:
+        idx_hold = bitmap_select(bitmaps, PROGRAM_PREDICATES["APREQ"], group)
+        print('APREQ gate hold pre filter')
+        print(idx_hold.sum())
+        ##### Filter out flights found previously
+        hold_metrics_df = df[claim_flights(bitmaps, claims, idx_hold, "APREQ")]
+    else:
+        hold_metrics_df = df[idx_group &
+                             idx_neg_at_gate &
+                             idx_reasonable_holds &
+                             idx_date]
+
+        print('APREQ gate hold pre filter')
+        print(len(hold_metrics_df))
+        ##### Filter out flights found previously
+        hold_metrics_df = hold_metrics_df[~hold_metrics_df['gufi'].isin(flight_list)]
     print(len(hold_metrics_df))
     print('APREQ gate hold post filter')
 
@@ -599,8 +1052,8 @@ def apreq_metrics_by_group(df, group,flight_list):
                      "hold_savings_co",
                      "hold_savings_co2",
                      "hold_savings_hc",
-                     "hold_savings_nox"]] = hold_metrics_df.apply(
-                         calc_emissions, axis=1, args=["effective_gate_hold"])
+                     "hold_savings_nox"]] = hold_emissions(
+                     hold_metrics_df, "effective_gate_hold")
 
     hold_metrics = hold_metrics_df.groupby(["year_month"]).agg(
             {"gufi":"count",
@@ -638,6 +1091,102 @@ def apreq_metrics_by_group(df, group,flight_list):
 
     return [metrics,flight_list]
 
+#### Actual and excess (above the monthly unimpeded time) taxi, ramp and
+#### movement area seconds of the departures of airport
+def departure_phases(df, group, airport):
+    if group:
+        idx_group = df["flight_category"] == group
+    else:
+        idx_group = df["gufi"].notnull()
+
+    idx_date = df["year_month"] != "nan-nan"
+    idx_departure = df["departure_aerodrome_icao_name"] == airport
+
+    df_taxi = df[idx_group & idx_date & idx_departure].reset_index(drop=True)
+    stand, spot, runway = [pd.to_datetime(df_taxi[c])
+                           for c in DEPARTURE_PHASE_TIMES]
+
+    phases = pd.DataFrame({
+            "gufi":df_taxi["gufi"],
+            "year_month":df_taxi["year_month"],
+            "aircraftType":df_taxi["aircraft_type"],
+            "weightClass":"D",
+            "TaxiTAct":(runway - stand).dt.total_seconds(),
+            "RampTAct":(spot - stand).dt.total_seconds(),
+            "MoveTAct":(runway - spot).dt.total_seconds()})
+
+    ##### Excess time is the time above the unimpeded time of the month
+    act_cols = ["TaxiTAct", "RampTAct", "MoveTAct"]
+    delay_cols = ["TaxiDelay", "RampDelay", "MoveDelay"]
+    unimpeded = phases.groupby("year_month")[act_cols].quantile(
+            UNIMPEDED_PHASE_QUANTILE)
+    unimpeded = unimpeded.reindex(phases["year_month"]).values
+    for i, (act, delay) in enumerate(zip(act_cols, delay_cols)):
+        phases[delay] = (phases[act] - unimpeded[:, i]).clip(lower=0)
+
+    return phases
+
+#### row_wise applies the legacy mops_emission row functions instead of
+#### the frame ones, for checking them against each other
+def excess_emission_metrics_by_group(df, group, airport, row_wise=False):
+    phases = departure_phases(df, group, airport)
+    act_cols = ["TaxiTAct", "RampTAct", "MoveTAct"]
+    delay_cols = ["TaxiDelay", "RampDelay", "MoveDelay"]
+
+    logger.debug("Begin computing phase emissions at {}".format(
+            dt.datetime.now()))
+    if row_wise:
+        emissions = [
+            ("total", phases.apply(mem.row_get_total_emission, axis=1)),
+            ("excess", phases.apply(mem.row_get_excess_emission, axis=1))]
+    else:
+        emissions = [("total", mem.frame_get_total_emission(phases)),
+                     ("excess", mem.frame_get_excess_emission(phases))]
+    columns = {}
+    for kind, em in emissions:
+        for i, (phase, _) in enumerate(EMISSION_PHASES):
+            for j, (species, _, factor) in enumerate(EMISSION_SPECIES):
+                columns["{}_{}_{}".format(kind, phase, species)] = (
+                        em[5*i + j].values * factor)
+    phases = phases.assign(**columns)
+    logger.debug("Finish computing phase emissions at {}".format(
+            dt.datetime.now()))
+
+    for col in act_cols + delay_cols:
+        phases[col] = phases[col] / 3600
+
+    excess_metrics = (
+            phases.drop(columns=["aircraftType", "weightClass"]).
+            groupby(["year_month"]).
+            agg(dict([("gufi", "count")] +
+                     [(col, "sum") for col in act_cols + delay_cols] +
+                     [(col, "sum") for col in columns])).
+            reset_index())
+
+    excess_metrics = excess_metrics.assign(
+            urban_trees_planted=excess_metrics["excess_taxi_co2"]*
+            LBS_TO_METRIC_TONS*METRIC_TONS_CO2_TO_URBAN_TREES)
+
+    labels = {
+            "gufi":"Count of departures",
+            "TaxiTAct":"Sum of taxi times (hours)",
+            "RampTAct":"Sum of ramp times (hours)",
+            "MoveTAct":"Sum of movement area times (hours)",
+            "TaxiDelay":"Sum of excess taxi times (hours)",
+            "RampDelay":"Sum of excess ramp times (hours)",
+            "MoveDelay":"Sum of excess movement area times (hours)",
+            "urban_trees_planted":"Urban trees equivalent of excess taxi CO2"}
+    for phase, phase_label in EMISSION_PHASES:
+        for species, species_label, _ in EMISSION_SPECIES:
+            labels["total_{}_{}".format(phase, species)] = (
+                    "{}{} during {} (pounds)".format(
+                    species_label[0].upper(), species_label[1:], phase_label))
+            labels["excess_{}_{}".format(phase, species)] = (
+                    "Excess {} during {} (pounds)".format(
+                    species_label, phase_label))
+
+    return excess_metrics.rename(columns=labels)
+
 def modify_data(df):
     df = df.assign(aobt_local=
             df.departure_stand_actual_time.dt.tz_localize("UTC").\
@@ -645,31 +1194,414 @@ def modify_data(df):
     df["year_month"] = df.apply(
             lambda x: "{}-{}".format(x.aobt_local.year, x.aobt_local.month),
             axis=1)
+    ##### Corrupt intervals (negative gate holds, a day or more of gate
+    ##### hold or negotiation) are quarantined by validate_data and left
+    ##### out of the sums, the flights themselves still count
+    negotiation = (df.apreq_initial - df.apreq_final).dt.total_seconds()
+    gate_hold = (df.departure_stand_actual_time -
+                 df.pilot_ready_time).dt.total_seconds()
     df = df.assign(negotiation_savings=
-            (df.apreq_initial - df.apreq_final).dt.seconds)
+            negotiation.where(negotiation < ONE_DAY_SECONDS))
     df = df.assign(effective_gate_hold=
-            (df.departure_stand_actual_time - df.pilot_ready_time).dt.seconds)
+            gate_hold.where((gate_hold >= 0) & (gate_hold < ONE_DAY_SECONDS)))
 
     return df
 
-def load_ffs_data(ffs_path, airport, ffs_version):
-    allFiles = glob.glob(os.path.join(ffs_path, "**",
-                   airport + ".fullFlightSummary.v" + ffs_version + "*.csv"),
-        recursive=True)
-
-    indiv_files = []
-    for f in allFiles:
-        df = pd.read_csv(f, index_col=None, header=0,
-                         parse_dates=["time_at_initial_apreq",
-                                      "apreq_initial",
-                                      "apreq_final",
-                                      "departure_stand_actual_time",
-                                      "pilot_ready_time"])
-        indiv_files.append(df)
-    df = pd.concat(indiv_files)
+#### Program membership predicates, packed into bitmaps once at load. The
+#### bitmaps are read-only and can be cached, the claims of a run are kept
+#### apart by new_claims()
+def build_program_bitmaps(df):
+    predicates = {
+        "valid_date":df["year_month"] != "nan-nan",
+        "has_gufi":df["gufi"].notnull(),
+        "edct":df["edct_at_ready"].notnull(),
+        "gs":df["ground_stop_restriction_ids_present"] == True,
+        "metered":df["metered_indicator"] == True,
+        "idac_savings":df["apreq_final"] < df["apreq_initial"],
+        "all_idac":((df["apreq_initial_source"] == "IDAC") &
+                    (df["apreq_final_source"] == "IDAC")),
+        "neg_at_gate":
+            df["surface_flight_state_at_initial_apreq"] == "SCHEDULED",
+        "reasonable_hold":df["effective_gate_hold"] <= 1800}
+    for month in df["year_month"].unique():
+        predicates["month:{}".format(month)] = df["year_month"] == month
+    for category in df["flight_category"].dropna().unique():
+        predicates["category:{}".format(category)] = (
+                df["flight_category"] == category)
+
+    ##### Claims are kept per gufi, as the flight lists were
+    gufi_codes, gufis = pd.factorize(df["gufi"])
+
+    return {
+        "n_flights":len(df),
+        "predicates":dict(
+            (name, np.packbits(np.asarray(idx, dtype=bool)))
+            for name, idx in predicates.items()),
+        "gufi_codes":gufi_codes,
+        "n_gufis":len(gufis)}
+
+def new_claims(bitmaps):
+    return {"claimed":np.zeros(bitmaps["n_gufis"], dtype=bool),
+            "programs":{}}
+
+def _packed_select(bitmaps, names, group=None):
+    if group:
+        names = list(names) + ["category:{}".format(group)]
+    empty = np.zeros((bitmaps["n_flights"] + 7) // 8, dtype=np.uint8)
+    packed = [bitmaps["predicates"].get(name, empty) for name in names]
+    return np.bitwise_and.reduce(packed)
+
+def bitmap_select(bitmaps, names, group=None):
+    return np.unpackbits(_packed_select(bitmaps, names, group),
+                         count=bitmaps["n_flights"]).astype(bool)
+
+def bitmap_count(bitmaps, names, group=None):
+    return int(np.unpackbits(_packed_select(bitmaps, names, group)).sum())
+
+#### Drop the selected flights whose gufi was claimed by an earlier
+#### program and claim the gufis of the rest for this program
+def claim_flights(bitmaps, claims, idx, program):
+    if program in claims["programs"]:
+        ##### Already resolved, e.g. over all months by resolve_claims()
+        return idx & np.unpackbits(claims["programs"][program],
+                                   count=bitmaps["n_flights"]).astype(bool)
+    codes = bitmaps["gufi_codes"]
+    idx = idx & (codes >= 0) & ~claims["claimed"][codes]
+    claims["claimed"][codes[idx]] = True
+    claims["programs"][program] = np.packbits(idx)
+    return idx
+
+#### Claims every program of PROGRAM_CLAIM_ORDER over all flights
+def resolve_claims(bitmaps, claims):
+    for program in PROGRAM_CLAIM_ORDER:
+        claim_flights(bitmaps, claims,
+                      bitmap_select(bitmaps, PROGRAM_PREDICATES[program]),
+                      program)
+    return claims
+
+#### Bitmaps and resolved claims of the flights at positions rows
+def slice_bitmaps(bitmaps, rows):
+    return {
+        "n_flights":len(rows),
+        "predicates":dict(
+            (name, np.packbits(np.unpackbits(
+                packed, count=bitmaps["n_flights"])[rows]))
+            for name, packed in bitmaps["predicates"].items()),
+        "gufi_codes":bitmaps["gufi_codes"][rows],
+        "n_gufis":bitmaps["n_gufis"]}
+
+def slice_claims(bitmaps, claims, rows):
+    return {"claimed":claims["claimed"],
+            "programs":dict(
+                (program, np.packbits(np.unpackbits(
+                    packed, count=bitmaps["n_flights"])[rows]))
+                for program, packed in claims["programs"].items())}
+
+#### Program each flight was claimed by, IDAC renegotiation savings are
+#### listed separately since those flights are not claimed
+def flight_attribution(df, bitmaps, claims):
+    programs = [(program, np.unpackbits(packed, count=bitmaps["n_flights"]).
+                 astype(bool))
+                for program, packed in claims["programs"].items()]
+    programs.append(
+            ("IDAC", bitmap_select(bitmaps, PROGRAM_PREDICATES["IDAC"])))
+
+    return pd.concat(
+            [pd.DataFrame({"gufi":df["gufi"].values[idx],
+                           "year_month":df["year_month"].values[idx],
+                           "program":program})
+             for program, idx in programs],
+            ignore_index=True)
+
+def reason_mask(codes):
+    mask = 0
+    for code in codes:
+        mask |= 1 << QUARANTINE_REASONS.index(code)
+    return mask
+
+#### Returns the QUARANTINE_REASONS bit mask of every flight of df
+def validate_data(df):
+    one_day = pd.Timedelta(days=1)
+    gate_hold = df.departure_stand_actual_time - df.pilot_ready_time
+    negotiation = df.apreq_initial - df.apreq_final
+    hold_flag = (df.hold_indicator == True).values
+
+    checks = {
+        "NAT_STAND_TIME":df.departure_stand_actual_time.isnull(),
+        "NAT_READY_TIME":df.pilot_ready_time.isnull(),
+        "NEGATIVE_GATE_HOLD":gate_hold < pd.Timedelta(0),
+        "OVERDAY_GATE_HOLD":gate_hold >= one_day,
+        "OVERDAY_NEGOTIATION":negotiation >= one_day,
+        "UNKNOWN_AIRCRAFT_TYPE":
+            ~df.aircraft_type.isin(mem.emissionAircraftTypes()),
+        "HOLD_WITHOUT_METERING":
+            hold_flag & (df.metered_indicator != True).values,
+        "HOLD_FLAG_MISMATCH":hold_flag != (df.actual_gate_hold > 0).values}
+
+    reasons = np.zeros(len(df), dtype=np.uint32)
+    for code, check in checks.items():
+        reasons[np.asarray(check, dtype=bool)] |= reason_mask([code])
+
+    return reasons
+
+def quarantine_flights(df, reasons):
+    idx_bad = reasons != 0
+    bad = reasons[idx_bad]
+    codes = pd.Series("", index=np.flatnonzero(idx_bad))
+    for code in QUARANTINE_REASONS:
+        has_code = (bad & reason_mask([code])) != 0
+        codes[has_code] = codes[has_code] + code + ";"
+
+    return pd.DataFrame({
+            "gufi":df["gufi"].values[idx_bad],
+            "year_month":df["year_month"].values[idx_bad],
+            "reason_mask":bad,
+            "reasons":codes.str.rstrip(";").values})
+
+def find_ffs_sources(ffs_path, airport, ffs_version):
+    file_pattern = airport + ".fullFlightSummary.v" + ffs_version + "*.csv"
+
+    sources = []
+    for suffix in ["", ".gz", ".zst"]:
+        allFiles = glob.glob(os.path.join(ffs_path, "**",
+                                          file_pattern + suffix),
+                             recursive=True)
+        if suffix == ".zst" and allFiles and zstandard is None:
+            logger.warning("Skipping {} .zst files, the zstandard package "
+                           "is not installed".format(len(allFiles)))
+            continue
+        sources.extend((f, None) for f in allFiles)
+
+    ##### Monthly bundles
+    for bundle in glob.glob(os.path.join(ffs_path, "**", "*.zip"),
+                            recursive=True):
+        with zipfile.ZipFile(bundle) as zf:
+            sources.extend(
+                    (bundle, member) for member in zf.namelist()
+                    if fnmatch.fnmatch(os.path.basename(member),
+                                       file_pattern))
+
+    return sorted(sources, key=lambda x: (x[0], x[1] or ""))
+
+#### Streams a (path, zip member) source through its decompressor
+def read_ffs_source(source):
+    path, member = source
+    with contextlib.ExitStack() as stack:
+        if member is not None:
+            bundle = stack.enter_context(zipfile.ZipFile(path))
+            f = stack.enter_context(bundle.open(member))
+        elif path.endswith(".gz"):
+            f = stack.enter_context(gzip.open(path, "rb"))
+        elif path.endswith(".zst"):
+            raw = stack.enter_context(open(path, "rb"))
+            f = stack.enter_context(
+                    zstandard.ZstdDecompressor().stream_reader(raw))
+        else:
+            f = stack.enter_context(open(path, "rb"))
+
+        return pd.read_csv(f, index_col=None, header=0,
+                           parse_dates=FFS_DATE_COLUMNS)
+
+#### Each thread decompresses and parses one source at a time, both of
+#### which release the GIL, so decompression overlaps with parsing
+#### With a single I/O thread the sources are read in the calling thread,
+#### where the profilers see them
+def read_ffs_sources(sources, io_threads=DEFAULT_IO_THREADS):
+    if io_threads <= 1:
+        return [read_ffs_source(source) for source in sources]
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        return list(executor.map(read_ffs_source, sources))
+
+def load_ffs_data(ffs_path, airport, ffs_version,
+                  io_threads=DEFAULT_IO_THREADS):
+    sources = find_ffs_sources(ffs_path, airport, ffs_version)
+    df = pd.concat(read_ffs_sources(sources, io_threads))
 
     return df
 
+def source_month(source):
+    path, member = source
+    match = FILE_MONTH_PATTERN.search(os.path.basename(member or path))
+    if match:
+        return "{}-{}".format(match.group(1), match.group(2))
+    return "unknown"
+
+#### Stratifies the sources by the month in their file name and draws a
+#### fraction (at least two) of each month's files without replacement.
+#### Files are the sampling units and each one holds flights of every
+#### program, so only months are strata, programs are not.
+#### Returns (source, stratum, files in stratum) tuples.
+def sample_ffs_sources(sources, fraction, seed=None):
+    rng = np.random.default_rng(seed)
+    strata = {}
+    for source in sources:
+        strata.setdefault(source_month(source), []).append(source)
+
+    sampled = []
+    for stratum, members in sorted(strata.items()):
+        n = min(len(members), max(2, int(np.ceil(fraction * len(members)))))
+        for i in sorted(rng.choice(len(members), n, replace=False)):
+            sampled.append((members[i], stratum, len(members)))
+
+    return sampled
+
+#### One row per flight and program with the flight's contribution to the
+#### program metrics, claims are resolved as in the full pipeline
+def flight_benefits(df, bitmaps):
+    claims = resolve_claims(bitmaps, new_claims(bitmaps))
+
+    frames = []
+    for program, (hold_col, hold_per_hour, fuel_col, co2_col) in (
+            PROGRAM_BENEFIT_COLUMNS.items()):
+        if program in claims["programs"]:
+            idx = np.unpackbits(claims["programs"][program],
+                                count=bitmaps["n_flights"]).astype(bool)
+        else:
+            idx = bitmap_select(bitmaps, PROGRAM_PREDICATES[program])
+        co2 = np.nan_to_num(df[co2_col].values[idx].astype(float))*KGS_TO_LBS
+        frames.append(pd.DataFrame({
+                "source_id":df["source_id"].values[idx],
+                "year_month":df["year_month"].values[idx],
+                "program":program,
+                "flights":1,
+                "hold_hours":np.nan_to_num(
+                    df[hold_col].values[idx].astype(float))/hold_per_hour,
+                "fuel_pounds":np.nan_to_num(
+                    df[fuel_col].values[idx].astype(float))*KGS_TO_LBS,
+                "co2_pounds":co2,
+                "urban_trees":co2*LBS_TO_METRIC_TONS*
+                    METRIC_TONS_CO2_TO_URBAN_TREES}))
+
+    return pd.concat(frames, ignore_index=True)
+
+#### Stratified estimates of the month/program totals. design has one row
+#### per sampled file (source_id, stratum, files_total); every month and
+#### program is estimated from the per-file totals of all strata. Programs
+#### are domains of the month strata, so a rare program (e.g. GS) whose
+#### flights sit in few files gets a wide, unstable interval.
+def estimate_sampled_totals(benefits, design):
+    totals = (benefits.groupby(["source_id", "year_month", "program"])
+              [SAMPLED_METRICS].sum().
+              unstack(["year_month", "program"], fill_value=0).
+              reindex(design["source_id"].values, fill_value=0))
+
+    by_stratum = totals.groupby(design["stratum"].values)
+    n = by_stratum.size()
+    N = design.groupby("stratum")["files_total"].first().reindex(n.index)
+    fpc = 1 - n / N
+    estimate = by_stratum.mean().mul(N, axis=0).sum()
+    variance = (by_stratum.var(ddof=1).fillna(0).
+                mul(N**2 * fpc / n, axis=0).sum())
+    std_error = np.sqrt(variance)
+
+    estimates = pd.DataFrame({
+            "estimate":estimate,
+            "standard_error":std_error,
+            "ci_lower":estimate - SAMPLE_CONFIDENCE_Z*std_error,
+            "ci_upper":estimate + SAMPLE_CONFIDENCE_Z*std_error})
+    estimates.index.names = ["metric", "year_month", "program"]
+
+    return (estimates.reset_index()
+            [["year_month", "program", "metric", "estimate",
+              "standard_error", "ci_lower", "ci_upper"]].
+            sort_values(["year_month", "program", "metric"]).
+            reset_index(drop=True))
+
+#### Quick-look of the metrics from sampled files. The sample is only
+#### modified, validate_data is not run since quarantined flights stay in
+#### the metrics.
+def sampled_benefits(ffs_path, ffs_version, airport, fraction,
+                     io_threads=DEFAULT_IO_THREADS, seed=None):
+    sampled = sample_ffs_sources(
+            find_ffs_sources(ffs_path, airport, ffs_version), fraction, seed)
+    design = pd.DataFrame({
+            "source_id":np.arange(len(sampled)),
+            "stratum":[stratum for _, stratum, _ in sampled],
+            "files_total":[files_total for _, _, files_total in sampled]})
+    logger.info("Sampled {} of {} files".format(
+            len(sampled),
+            design.groupby("stratum")["files_total"].first().sum()))
+
+    frames = read_ffs_sources([source for source, _, _ in sampled],
+                              io_threads)
+    df = pd.concat([f.assign(source_id=i) for i, f in enumerate(frames)])
+    df = modify_data(df)
+    df = df.assign(**flight_emissions(df))
+
+    benefits = flight_benefits(df, build_program_bitmaps(df))
+
+    return estimate_sampled_totals(benefits, design)
+
+#### Per-flight emissions of every HOLD_EMISSION_COLUMNS field, computed
+#### in bulk. With a cache_dir they are reused while the emission table
+#### and the hold-time inputs keep the same hashes.
+def flight_emissions(df, cache_dir=None):
+    inputs = df[["gufi", "aircraft_type"] + list(HOLD_EMISSION_COLUMNS)]
+    key = {"table":mem.emissionTableHash(),
+           "inputs":hashlib.sha256(pd.util.hash_pandas_object(
+               inputs, index=False).values).hexdigest()}
+
+    if cache_dir:
+        cached = read_cache(os.path.join(cache_dir, EMISSIONS_CACHE), key)
+        if cached is not None:
+            logger.info("Using cached flight emissions from {}".format(
+                    cache_dir))
+            return cached
+
+    rates = mem.frame_get_emission_rates(pd.DataFrame({
+            "aircraftType":df["aircraft_type"].values,
+            "weightClass":"D"}))
+    emissions = {}
+    for field, columns in HOLD_EMISSION_COLUMNS.items():
+        results = mem.frame_get_emissions_for_interval(rates, df[field])
+        for column, result in zip(columns, results):
+            emissions[column] = result.values
+
+    if cache_dir:
+        write_cache(os.path.join(cache_dir, EMISSIONS_CACHE), key, emissions)
+
+    return emissions
+
+def flights_cache_key(ffs_path, ffs_version, airport):
+    sources = []
+    for path, member in find_ffs_sources(ffs_path, airport, ffs_version):
+        stat = os.stat(path)
+        sources.append((path, member, stat.st_size, stat.st_mtime_ns))
+
+    return {"version":FLIGHTS_CACHE_VERSION,
+            "airport":airport,
+            "ffs_version":ffs_version,
+            "sources":sources}
+
+#### Cache files hold a (key, payload) pair, the payload is only returned
+#### when the stored key equals the expected one
+def read_cache(path, key):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        [cached_key, payload] = pickle.load(f)
+    if cached_key != key:
+        logger.info("Cache {} is stale".format(path))
+        return None
+    return payload
+
+def write_cache(path, key, payload):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump([key, payload], f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+def hold_emissions(df, field):
+    columns = HOLD_EMISSION_COLUMNS.get(field, [])
+    if columns and all(c in df.columns for c in columns):
+        precomputed = df[columns]
+        precomputed.columns = ["fuel", "co", "co2", "hc", "nox"]
+        return precomputed
+    if len(df) == 0:
+        return pd.DataFrame(columns=["fuel", "co", "co2", "hc", "nox"],
+                            index=df.index, dtype=float)
+    return df.apply(calc_emissions, axis=1, args=[field])
+
 def calc_emissions(row, field):
     em_input = pd.DataFrame({
             "aircraftType":row["aircraft_type"],
@@ -683,6 +1615,13 @@ def calc_emissions(row, field):
     return pd.Series(list(em_results.iloc[0:5]),
                      index=["fuel", "co", "co2", "hc", "nox"])
 
+def sample_fraction(value):
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError(
+                "{} is not a fraction in (0, 1]".format(value))
+    return fraction
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate aggregate metrics")
     parser.add_argument("ffs_path",
@@ -693,6 +1632,50 @@ if __name__ == "__main__":
     parser.add_argument("--airport",
                         default=DEFAULT_AIRPORT,
                         help="Airport to analyze, ICAO format")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes computing the metrics, "
+                             "with the flights partitioned by month")
+    parser.add_argument("--io_threads",
+                        type=int,
+                        default=DEFAULT_IO_THREADS,
+                        help="Number of threads decompressing and parsing "
+                             "fullFlightSummary files")
+    parser.add_argument("--cache_dir",
+                        help="Directory caching the processed flights and "
+                             "their emissions between runs")
+    parser.add_argument("--db",
+                        help="SQLite database accumulating the outputs "
+                             "of every run")
+    parser.add_argument("--sample",
+                        type=sample_fraction,
+                        metavar="FRACTION",
+                        help="Quick-look estimates with confidence intervals "
+                             "from this fraction of each month's files")
+    parser.add_argument("--sample_seed",
+                        type=int,
+                        help="Random seed of the --sample file selection")
+    parser.add_argument("--profile",
+                        nargs="?",
+                        const="benefits_profile_{}".format(
+                            dt.datetime.now().strftime("%Y%m%d")),
+                        metavar="PREFIX",
+                        help="Profile the run and write PREFIX.txt, "
+                             "PREFIX.collapsed and PREFIX.prof")
     args = parser.parse_args()
 
-    main(args.ffs_path, args.ffs_version, args.airport)
+    if args.profile:
+        ##### cProfile only sees the calling thread, so the files are
+        ##### read there instead of in I/O threads
+        if args.io_threads > 1:
+            logger.warning("Profiling with --io_threads 1")
+        bprof.profile_call(main,
+                           (args.ffs_path, args.ffs_version, args.airport,
+                            args.jobs, 1, args.cache_dir,
+                            args.db, args.sample, args.sample_seed),
+                           args.profile)
+    else:
+        main(args.ffs_path, args.ffs_version, args.airport, args.jobs,
+             args.io_threads, args.cache_dir, args.db, args.sample,
+             args.sample_seed)
@@ -6,8 +6,10 @@ __email__ = "amir.h.farrahi@nasa.gov"
 
 #-------------------------------------------------------------------------------------------------------------------------------------
 
+import hashlib
 import os.path
 import sys
+import numpy as np
 import pandas as pd
 
 #-------------------------------------------------------------------------------------------------------------------------------------
@@ -107,6 +109,73 @@ def getEmissionsForInterval(aircraftType, weightClass, seconds):
     noxGr      = fuelFlowKg * row.noxGrPerKgFuelFlow.values[0]
     return fuelFlowKg, coGr, co2Kg, hcGr, noxGr
 
+#-------------------------------------------------------------------------------------------------------------------------------------
+# Vectorized counterparts of the functions above.  frame_get_emission_rates() resolves the emission table row of every flight in a
+# dataFrame with the 'aircraftType', 'weightClass' columns, using the same 'Other'/weightClass fallback as getEmissionsForInterval()
+# (flights without any matching row get zero rates).  The frame_* emission functions then return the same 15 columns, in the same
+# order, as df.apply(row_get_total_emission, axis=1) and df.apply(row_get_excess_emission, axis=1).
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+EMISSION_RATE_COLUMNS = ['fuelFlowKgPerSecond', 'coGrPerKgFuelFlow', 'co2KgPerKgFuelFlow', 'hcGrPerKgFuelFlow', 'noxGrPerKgFuelFlow']
+
+def frame_get_emission_rates(df):
+    if _emission_df is None:
+        print('(E): frame_get_emission_rates(): Emission table needs to be initialized first.  Returning zeros.')
+        return pd.DataFrame(0.0, index=df.index, columns=EMISSION_RATE_COLUMNS)
+    byType  = _emission_df.drop_duplicates('aircraftType').set_index('aircraftType')[EMISSION_RATE_COLUMNS]
+    others  = _emission_df[_emission_df.aircraftType == 'Other']
+    byClass = others.drop_duplicates('weightClass').set_index('weightClass')[EMISSION_RATE_COLUMNS]
+
+    rates    = byType.reindex(df.aircraftType.values).reset_index(drop=True)
+    fallback = byClass.reindex(df.weightClass.values).reset_index(drop=True)
+    noType   = rates.fuelFlowKgPerSecond.isnull().values
+    rates.loc[noType] = fallback.loc[noType].values
+    rates.index = df.index
+    return rates.fillna(0.0)
+
+def frame_get_emissions_for_interval(rates, seconds):
+    seconds    = pd.Series(np.asarray(seconds, dtype=float), index=rates.index)
+    seconds    = seconds.where(seconds > 0, 0.0)
+    fuelFlowKg = seconds * rates.fuelFlowKgPerSecond
+    coGr       = fuelFlowKg * rates.coGrPerKgFuelFlow
+    co2Kg      = fuelFlowKg * rates.co2KgPerKgFuelFlow
+    hcGr       = fuelFlowKg * rates.hcGrPerKgFuelFlow
+    noxGr      = fuelFlowKg * rates.noxGrPerKgFuelFlow
+    return fuelFlowKg, coGr, co2Kg, hcGr, noxGr
+
+def _frame_get_phase_emission(df, taxiCol, rampCol, moveCol):
+    rates   = frame_get_emission_rates(df)
+    results = (frame_get_emissions_for_interval(rates, df[taxiCol]) +
+               frame_get_emissions_for_interval(rates, df[rampCol]) +
+               frame_get_emissions_for_interval(rates, df[moveCol]))
+    return pd.concat(results, axis=1, ignore_index=True)
+
+def frame_get_total_emission(df):
+    return _frame_get_phase_emission(df, 'TaxiTAct', 'RampTAct', 'MoveTAct')
+
+def frame_get_excess_emission(df):
+    return _frame_get_phase_emission(df, 'TaxiDelay', 'RampDelay', 'MoveDelay')
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+# Return a content hash of the emission table, so results computed from it can be cached and invalidated when it changes:
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def emissionTableHash():
+    if _emission_df is None:
+        print('(E): emissionTableHash(): Emission table needs to be initialized first.  Returning none.')
+        return None
+    return hashlib.sha256(_emission_df.to_csv(index=False).encode('utf-8')).hexdigest()
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+# Return the aircraft types that have their own row in the emission table (all others fall back to the 'Other' rows):
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def emissionAircraftTypes():
+    if _emission_df is None:
+        print('(E): emissionAircraftTypes(): Emission table needs to be initialized first.  Returning none.')
+        return []
+    return _emission_df.aircraftType[_emission_df.aircraftType != 'Other'].unique().tolist()
+
 #-------------------------------------------------------------------------------------------------------------------------------------
 
 def emissionRow(aircraftType, weightClass):